@@ -1,24 +1,116 @@
 import streamlit as st
-import google.generativeai as genai
-from pinecone import Pinecone
+from collections import OrderedDict
+import asyncio
+import functools
+import hashlib
+import html
+import json
+import logging
+import numpy as np
+import random
 import re
+import threading
 import time
 
 # ---------------- Configuración -----------------
 GENAI_API_KEY     = st.secrets["GENAI_API_KEY"]
 PINECONE_API_KEY  = st.secrets["PINECONE_API_KEY"]
 INDEX_NAME = "proyecto-aemet"
+LOG_LEVEL = st.secrets.get("LOG_LEVEL", "INFO")
 MIN_SIMILARITY_SCORE = 0.50  # umbral mínimo de similitud
 TOP_K = 5  # número de fragmentos a recuperar
+EMBEDDING_DIM = 768  # dimensión de text-embedding-004
+SEMANTIC_CACHE_THRESHOLD = 0.95  # similitud mínima para reutilizar una respuesta
+LSH_BITS = 16  # bits de la firma LSH de la caché semántica
+EXPANSION_MAX_WORDS = 8  # las consultas más largas se vectorizan sin expandir
+QUERY_VARIANTS = 3  # paráfrasis generadas al expandir la consulta
+EMBED_CACHE_SIZE = 1024  # embeddings recientes guardados por sesión
+PINECONE_CACHE_TTL = 30 * 60  # segundos que se reutilizan los resultados de Pinecone
+PINECONE_CACHE_SIZE = 256  # consultas a Pinecone recientes guardadas por sesión
+FRAGMENT_CACHE_SIZE = 1024  # textos de fragmentos recientes guardados por sesión
+CONTEXT_TOKEN_BUDGET = 4000  # tokens estimados de fragmentos a partir de los cuales se sintetizan
+HISTORY_WINDOW = 8  # mensajes recientes (4 turnos) incluidos literalmente en el prompt
+HISTORY_TOKEN_BUDGET = 2000  # tokens estimados máximos de la ventana y de los mensajes pendientes de resumir
+SUMMARY_INTERVAL = 16  # mensajes (8 turnos) fuera de la ventana que disparan un nuevo resumen
 USER_ICON     = "👤"
 ASSISTANT_ICON = "🤖"
+GENERATION_ERROR_MESSAGE = "No se pudo generar una respuesta. Por favor, intenta reformular tu consulta."
+RETRIEVAL_ERROR_CONTEXT = "No se pudieron consultar los fragmentos del pliego por un error del servicio de búsqueda."
 
 
-# Inicializar APIs
-genai.configure(api_key=GENAI_API_KEY)
-model = genai.GenerativeModel("gemini-2.0-flash-lite")
-pc = Pinecone(api_key=PINECONE_API_KEY)
-index = pc.Index(INDEX_NAME)
+# Logging: las trazas de depuración solo se emiten con LOG_LEVEL = "DEBUG"
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
+if not logger.handlers:  # el logger sobrevive a las reejecuciones del script
+    logger.addHandler(logging.StreamHandler())
+
+# Bucle de eventos persistente en un hilo propio. Los clientes asíncronos (gRPC-aio de Gemini,
+# aiohttp de Pinecone) quedan ligados al bucle en el que se crean, y cada turno se ejecuta con
+# asyncio.run en un bucle nuevo que se cierra al terminar; por eso sus llamadas se despachan aquí.
+@st.cache_resource
+def get_io_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="io-loop", daemon=True).start()
+    return loop
+
+def on_io_loop(coro):
+    """Ejecuta coro en el bucle persistente y devuelve un awaitable para el bucle del turno"""
+    return asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, get_io_loop()))
+
+# Inicializar APIs (una sola vez por proceso: Streamlit reejecuta el script en cada interacción).
+# google.generativeai y pinecone se importan aquí dentro para no cargar protobuf/gRPC
+# antes de pintar la página.
+@st.cache_resource
+def get_genai():
+    import google.generativeai as genai
+    genai.configure(api_key=GENAI_API_KEY)
+    return genai
+
+@st.cache_resource
+def get_model():
+    return get_genai().GenerativeModel("gemini-2.0-flash-lite")
+
+@st.cache_resource
+def get_pinecone():
+    from pinecone import Pinecone
+    return Pinecone(api_key=PINECONE_API_KEY)
+
+# El cliente síncrono solo resuelve el host del índice; las consultas usan IndexAsyncio
+@st.cache_resource
+def get_index_host():
+    return get_pinecone().describe_index(INDEX_NAME).host
+
+@st.cache_resource
+def get_async_index():
+    """Único IndexAsyncio del proceso, creado en el bucle persistente para reutilizar sus conexiones"""
+    pc, host = get_pinecone(), get_index_host()
+    async def build():
+        return pc.IndexAsyncio(host=host)
+    return asyncio.run_coroutine_threadsafe(build(), get_io_loop()).result()
+
+# Primera llamada con los mismos clientes que usa cada turno al arrancar el proceso, para que
+# la primera consulta no pague el arranque en frío (DNS, TLS, canal gRPC y carga del modelo)
+@st.cache_resource(show_spinner="Preparando el asistente...")
+def warmup():
+    warmup_vector = [1.0] + [0.0] * (EMBEDDING_DIM - 1)
+    async def warm_async_clients(genai, model, index):
+        # Clientes asíncronos del pipeline: embeddings, expansión y consulta a Pinecone
+        await asyncio.gather(
+            genai.embed_content_async(model="models/text-embedding-004", content="warmup"),
+            model.generate_content_async("ok", generation_config={"max_output_tokens": 1}),
+            index.query(vector=warmup_vector, top_k=1),
+        )
+    try:
+        # Rutinas LSH de la caché semántica: compilación con numba o respaldo en numpy
+        lsh_signature, hamming_neighbors = get_lsh_kernels()
+        signature = lsh_signature(np.zeros((LSH_BITS, EMBEDDING_DIM), dtype=np.float32), np.asarray(warmup_vector, dtype=np.float32))
+        hamming_neighbors(int(signature), LSH_BITS)
+        genai, model, index = get_genai(), get_model(), get_async_index()
+        asyncio.run_coroutine_threadsafe(warm_async_clients(genai, model, index), get_io_loop()).result()
+        # Cliente síncrono usado por la respuesta final en streaming
+        model.generate_content("ok", generation_config={"max_output_tokens": 1})
+    except Exception as e:
+        logger.debug("Error en el calentamiento: %s", e)
 
 # ---------------- Estilos -----------------
 st.set_page_config(
@@ -37,6 +129,15 @@ st.markdown("""
         h1, h2, h3 { font-weight: 600; color: #0066cc; }
     </style>
 """, unsafe_allow_html=True)
+# Sin sangría ni líneas en blanco: al concatenar varios fragmentos, una línea sangrada tras
+# una línea en blanco se interpretaría en Markdown como bloque de código
+FRAGMENT_TEMPLATE = (
+    '<div class="fragment-container">'
+    '<div class="fragment-source">📄 Sección: {documento}</div>'
+    '<div class="fragment-score">🔍 Similitud: {score}</div>'
+    '<div class="fragment-content">{texto}</div>'
+    '</div>'
+)
 
 # ---------------- Prompt Base -----------------
 CUSTOM_PROMPT = '''
@@ -55,56 +156,428 @@ Instrucciones:
 - Sé conciso y estructurado en tus respuestas
 - Cita textualmente partes del pliego cuando sea posible
 '''
+# Plantilla del prompt final, construida una sola vez; se rellena con str.format_map
+FINAL_TEMPLATE = CUSTOM_PROMPT + "\n\nHistorial de conversación:\n{hist}\n\nFragmentos del pliego:\n{ctx}\n\nConsulta actual: {q}"
+
+# ---------------- Caché semántica -----------------
+def _lsh_signature_loop(planes, vec):
+    signature = 0
+    for i in range(planes.shape[0]):
+        s = 0.0
+        for j in range(planes.shape[1]):
+            s += planes[i, j] * vec[j]
+        if s > 0:
+            signature |= 1 << i
+    return signature
+
+def _hamming_neighbors_loop(signature, n_bits):
+    # La propia firma y las que difieren en un solo bit
+    neighbors = np.empty(n_bits + 1, dtype=np.int64)
+    neighbors[0] = signature
+    for bit in range(n_bits):
+        neighbors[bit + 1] = signature ^ (1 << bit)
+    return neighbors
+
+def _lsh_signature_numpy(planes, vec):
+    return int(np.dot((planes @ vec) > 0, 1 << np.arange(len(planes))))
+
+def _hamming_neighbors_numpy(signature, n_bits):
+    return signature ^ np.concatenate(([0], 1 << np.arange(n_bits)))
+
+@st.cache_resource
+def get_lsh_kernels():
+    """Rutinas LSH compiladas con numba una vez por proceso; si numba no está o no puede
+    compilarlas (p. ej. sin ubicación para su caché), sus equivalentes en numpy"""
+    try:
+        from numba import njit
+        lsh_signature = njit(cache=True, fastmath=True)(_lsh_signature_loop)
+        hamming_neighbors = njit(cache=True)(_hamming_neighbors_loop)
+        # Compilar ya con los tipos reales para que cualquier fallo caiga aquí y no en una consulta
+        lsh_signature(np.zeros((LSH_BITS, EMBEDDING_DIM), dtype=np.float32), np.zeros(EMBEDDING_DIM, dtype=np.float32))
+        hamming_neighbors(0, LSH_BITS)
+    except Exception as e:
+        logger.debug("Rutinas LSH sin numba: %s", e)
+        return _lsh_signature_numpy, _hamming_neighbors_numpy
+    return lsh_signature, hamming_neighbors
+
+class SemanticCache:
+    """Caché semántica de respuestas indexada por LSH de proyecciones aleatorias.
+
+    Los vectores normalizados se guardan como filas de una matriz float32 contigua, de modo
+    que la similitud con todos los candidatos se calcula con un único producto matricial.
+    """
+
+    def __init__(self, n_bits=LSH_BITS, dim=EMBEDDING_DIM, threshold=SEMANTIC_CACHE_THRESHOLD, seed=0, capacity=64):
+        self.n_bits = n_bits
+        self.threshold = threshold
+        self.planes = np.random.default_rng(seed).standard_normal((n_bits, dim)).astype(np.float32)
+        self.matrix = np.empty((capacity, dim), dtype=np.float32)
+        self.entries = []  # (retrieved, context, answer) de cada fila de la matriz
+        self.buckets = {}  # firma LSH -> filas de la matriz
+
+    def _signature(self, vec):
+        lsh_signature, _ = get_lsh_kernels()
+        return int(lsh_signature(self.planes, vec))
+
+    def _candidate_buckets(self, signature):
+        # El propio bucket y los vecinos a distancia de Hamming 1
+        _, hamming_neighbors = get_lsh_kernels()
+        return hamming_neighbors(signature, self.n_bits).tolist()
+
+    @staticmethod
+    def _normalize(vec):
+        vec = np.asarray(vec, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def lookup(self, vec):
+        """Devuelve (retrieved, context, answer) si hay una consulta similar"""
+        query = self._normalize(vec)
+        rows = [row for signature in self._candidate_buckets(self._signature(query)) for row in self.buckets.get(signature, ())]
+        if not rows:
+            return None
+        sims = self.matrix[rows] @ query
+        best = int(np.argmax(sims))
+        return self.entries[rows[best]] if sims[best] >= self.threshold else None
+
+    def insert(self, vec, retrieved, context, answer):
+        row = len(self.entries)
+        if row == len(self.matrix):
+            # Crecimiento geométrico para que la inserción sea O(1) amortizada
+            grown = np.empty((2 * len(self.matrix), self.matrix.shape[1]), dtype=np.float32)
+            grown[:row] = self.matrix
+            self.matrix = grown
+        self.matrix[row] = self._normalize(vec)
+        self.entries.append((retrieved, context, answer))
+        self.buckets.setdefault(self._signature(self.matrix[row]), []).append(row)
 
 # ---------------- Estado -----------------
 if "conversation" not in st.session_state:
     st.session_state.conversation = []
+if "history_summary" not in st.session_state:
+    st.session_state.history_summary = ""
+if "summarized_messages" not in st.session_state:
+    st.session_state.summarized_messages = 0
+if "semantic_cache" not in st.session_state:
+    st.session_state.semantic_cache = SemanticCache()
+if "embed_cache" not in st.session_state:
+    st.session_state.embed_cache = OrderedDict()
+if "pinecone_cache" not in st.session_state:
+    st.session_state.pinecone_cache = OrderedDict()
+if "fragment_cache" not in st.session_state:
+    st.session_state.fragment_cache = OrderedDict()
 
 # ---------------- Funciones ----------------
 def display_fragments(fragments):
     if not fragments:
         st.info("No se encontraron fragmentos relevantes del pliego.")
         return
-    for fragment in fragments:
-        st.markdown(f"""
-        <div class=\"fragment-container\">
-            <div class=\"fragment-source\">📄 Sección: {fragment['documento']}</div>
-            <div class=\"fragment-score\">🔍 Similitud: {fragment['score']:.2%}</div>
-            <div class=\"fragment-content\">{fragment['texto']}</div>
-        </div>
-        """, unsafe_allow_html=True)
+    # Un único st.markdown para todos los fragmentos
+    scores = [f"{fragment['score']:.2%}" for fragment in fragments]
+    fragments_html = "".join(
+        FRAGMENT_TEMPLATE.format(documento=html.escape(fragment['documento']), score=score, texto=html.escape(fragment['texto']))
+        for fragment, score in zip(fragments, scores)
+    )
+    st.markdown(fragments_html, unsafe_allow_html=True)
 
 def format_history(conversation):
-    return "\n".join([f"{msg['role']}: {msg['content']}" for msg in conversation])
+    """Historial para el prompt: resumen de los mensajes antiguos, los que salieron de la ventana
+    y aún no se han resumido, y la ventana de los más recientes recortada por tokens"""
+    window_start = max(len(conversation) - HISTORY_WINDOW, st.session_state.summarized_messages)
+    pending = conversation[st.session_state.summarized_messages:window_start]
+    lines = []
+    budget = HISTORY_TOKEN_BUDGET * 4  # ~4 caracteres por token
+    for msg in reversed(conversation[window_start:]):
+        line = f"{msg['role']}: {msg['content']}"
+        budget -= len(line)
+        if budget < 0 and lines:
+            break
+        lines.append(line)
+    formatted = "\n".join([f"{msg['role']}: {msg['content']}" for msg in pending] + lines[::-1])
+    if st.session_state.history_summary:
+        formatted = f"Resumen de la conversación anterior: {st.session_state.history_summary}\n{formatted}"
+    return formatted
+
+def should_expand(query):
+    """Indica si merece la pena expandir la consulta antes de vectorizarla"""
+    return len(query.split()) < EXPANSION_MAX_WORDS and not re.search(r"\b(artículo|sección|apartado|cláusula)\b", query, re.I)
+
+def cache_lookup(query_vector):
+    """Busca en la caché semántica una respuesta para un vector de consulta similar"""
+    return st.session_state.semantic_cache.lookup(query_vector)
 
-def safe_generate_content(prompt, max_retries=3):
+class MalformedResponseError(Exception):
+    """La API respondió, pero sin el contenido esperado"""
+
+def is_transient(error):
+    """Errores de la API de Gemini tras los que merece la pena esperar antes de reintentar"""
+    from google.api_core import exceptions as google_exceptions
+    return isinstance(error, (
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.InternalServerError,
+    ))
+
+def backoff_delay(attempt):
+    """Espera exponencial con jitter: 1s, 2s, 4s... hasta 8s, más hasta 1s aleatorio"""
+    return min(2 ** attempt, 8) + random.random()
+
+def _retry(error_label, fallback=None, max_retries=3):
+    """Decorador de reintentos para las llamadas asíncronas a Gemini.
+
+    Solo espera (con backoff_delay) tras errores transitorios; una respuesta con formato
+    inesperado se reintenta una única vez sin esperar. Si todo falla devuelve fallback.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            malformed = False
+            for attempt in range(max_retries):
+                try:
+                    return await fn(*args, **kwargs)
+                except MalformedResponseError:
+                    if malformed:
+                        break
+                    malformed = True
+                except Exception as e:
+                    st.warning(f"{error_label} (intento {attempt+1}): {str(e)}")
+                    if is_transient(e) and attempt + 1 < max_retries:
+                        await asyncio.sleep(backoff_delay(attempt))
+            return fallback
+        return wrapper
+    return decorator
+
+@_retry("Error al generar contenido", fallback=GENERATION_ERROR_MESSAGE)
+async def safe_generate_content(prompt):
     """Función para generar contenido con manejo de errores y reintentos"""
+    response = await on_io_loop(get_model().generate_content_async(prompt))
+    if hasattr(response, 'candidates') and response.candidates:
+        if hasattr(response.candidates[0].content, 'parts'):
+            return response.candidates[0].content.parts[0].text.strip()
+    raise MalformedResponseError()
+
+@_retry("Error al generar embedding")
+async def _embed_contents(contents):
+    # La API acepta una lista de textos y devuelve un embedding por texto;
+    # se convierten una sola vez a float32 y se valida su dimensión
+    embed = await on_io_loop(get_genai().embed_content_async(model="models/text-embedding-004", content=contents))
+    if 'embedding' in embed:
+        embeddings = np.asarray(embed['embedding'], dtype=np.float32)
+        if embeddings.shape == (len(contents), EMBEDDING_DIM):
+            return embeddings
+    raise MalformedResponseError()
+
+async def safe_embed_contents(contents):
+    """Genera los embeddings (float32) de varios textos en una sola llamada, con caché LRU por SHA-256.
+
+    Devuelve None si no se pudieron generar.
+    """
+    embed_cache = st.session_state.embed_cache
+    keys = [hashlib.sha256(content.encode()).hexdigest() for content in contents]
+    embeddings = {key: embed_cache[key] for key in keys if key in embed_cache}
+    for key in embeddings:
+        embed_cache.move_to_end(key)
+    missing = {key: content for key, content in zip(keys, contents) if key not in embeddings}
+    if missing:
+        new_embeddings = await _embed_contents(list(missing.values()))
+        if new_embeddings is None:
+            return None
+        for key, embedding in zip(missing, new_embeddings):
+            embeddings[key] = embed_cache[key] = embedding
+            if len(embed_cache) > EMBED_CACHE_SIZE:
+                embed_cache.popitem(last=False)
+    return [embeddings[key] for key in keys]
+
+async def safe_embed_content(content):
+    """Función para generar embeddings con manejo de errores, reintentos y caché LRU por SHA-256"""
+    embeddings = await safe_embed_contents([content])
+    return embeddings[0] if embeddings else None
+
+def parse_variants(text):
+    """Extrae la lista JSON de paráfrasis devuelta por el modelo; None si no es válida"""
+    match = re.search(r"\[.*\]", text, re.S)
+    if not match:
+        return None
+    try:
+        variants = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(variants, list):
+        return None
+    variants = [v.strip() for v in variants if isinstance(v, str) and v.strip()]
+    return variants[:QUERY_VARIANTS] or None
+
+async def query_pinecone(index, query_vector):
+    """Consulta Pinecone sin metadatos y devuelve id y similitud de los que superan el umbral"""
+    matches = []
+    query_res = await on_io_loop(index.query(vector=query_vector.tolist(), top_k=TOP_K, include_metadata=False))
+    for m in query_res.get('matches', []):
+        score = m.get('score', 0)
+        if score >= MIN_SIMILARITY_SCORE:
+            matches.append({'id': m.get('id'), 'score': score})
+    return matches
+
+async def fetch_fragments(index, matches):
+    """Completa los matches con texto y documento, descargando solo los que no están en caché"""
+    fragment_cache = st.session_state.fragment_cache
+    fragments = {m['id']: fragment_cache[m['id']] for m in matches if m['id'] in fragment_cache}
+    for vector_id in fragments:
+        fragment_cache.move_to_end(vector_id)
+    missing = [m['id'] for m in matches if m['id'] not in fragments]
+    if missing:
+        fetch_res = await on_io_loop(index.fetch(ids=missing))
+        for vector_id, vector in fetch_res.vectors.items():
+            meta = vector.metadata or {}
+            fragments[vector_id] = fragment_cache[vector_id] = {'texto': meta.get('texto',''), 'documento': meta.get('documento','')}
+            if len(fragment_cache) > FRAGMENT_CACHE_SIZE:
+                fragment_cache.popitem(last=False)
+    return [{'id': m['id'], **fragments[m['id']], 'score': m['score']} for m in matches if m['id'] in fragments]
+
+def merge_matches(results):
+    """Une los matches recuperados con varios vectores quedándose con la mayor similitud"""
+    best = {}
+    for fragments in results:
+        for fragment in fragments:
+            if fragment['id'] not in best or fragment['score'] > best[fragment['id']]['score']:
+                best[fragment['id']] = fragment
+    return sorted(best.values(), key=lambda f: f['score'], reverse=True)[:TOP_K]
+
+def pinecone_cache_key(query_vector):
+    # La cuantización a float16 hace que vectores casi idénticos compartan clave
+    return hashlib.blake2b(np.asarray(query_vector, dtype=np.float16).tobytes(), digest_size=16).digest()
+
+async def get_or_fetch(key, fetch_fn):
+    """Devuelve el resultado cacheado para key si no ha caducado; si no, lo obtiene con fetch_fn.
+
+    La caché es un LRU de PINECONE_CACHE_SIZE entradas y las caducadas se descartan al consultarlas.
+    """
+    pinecone_cache = st.session_state.pinecone_cache
+    if key in pinecone_cache:
+        result, timestamp = pinecone_cache[key]
+        if time.time() - timestamp < PINECONE_CACHE_TTL:
+            pinecone_cache.move_to_end(key)
+            return result
+        del pinecone_cache[key]
+    result = await fetch_fn()
+    pinecone_cache[key] = (result, time.time())
+    if len(pinecone_cache) > PINECONE_CACHE_SIZE:
+        pinecone_cache.popitem(last=False)
+    return result
+
+def safe_stream_content(prompt, stream_status, max_retries=3):
+    """Genera contenido en streaming; solo reintenta si el fallo ocurre antes del primer fragmento.
+
+    Si el stream se corta a medias marca stream_status['interrupted'], porque el texto
+    devuelto por st.write_stream estará incompleto.
+    """
+    malformed = False
     for attempt in range(max_retries):
+        started = False
         try:
-            response = model.generate_content(prompt)
-            if hasattr(response, 'candidates') and response.candidates:
-                if hasattr(response.candidates[0].content, 'parts'):
-                    return response.candidates[0].content.parts[0].text.strip()
-            # Si llegamos aquí, hubo un problema con el formato de respuesta
-            time.sleep(1)  # Esperar brevemente antes de reintentar
+            for chunk in get_model().generate_content(prompt, stream=True):
+                text = chunk.text
+                started = True
+                yield text
+            if started:
+                return
+            # Stream vacío: se reintenta una única vez sin esperar
+            if malformed:
+                break
+            malformed = True
         except Exception as e:
-            st.warning(f"Error en intento {attempt+1}: {str(e)}")
-            time.sleep(1)  # Esperar antes de reintentar
+            st.warning(f"Error al generar contenido (intento {attempt+1}): {str(e)}")
+            if started:
+                # La respuesta ya se está mostrando: no se puede reintentar
+                stream_status['interrupted'] = True
+                return
+            if is_transient(e) and attempt + 1 < max_retries:
+                time.sleep(backoff_delay(attempt))
     # Si todos los intentos fallan
-    return "No se pudo generar una respuesta. Por favor, intenta reformular tu consulta."
+    yield GENERATION_ERROR_MESSAGE
 
-def safe_embed_content(content, max_retries=3):
-    """Función para generar embeddings con manejo de errores y reintentos"""
-    for attempt in range(max_retries):
+async def update_history_summary(conversation):
+    """Resume los mensajes que han salido de la ventana cuando ya son SUMMARY_INTERVAL o cuando
+    superan HISTORY_TOKEN_BUDGET; hasta entonces van literales en el prompt"""
+    trimmed = conversation[:-HISTORY_WINDOW]
+    pending = trimmed[st.session_state.summarized_messages:]
+    pending_chars = sum(len(msg['content']) for msg in pending)
+    over_budget = pending_chars // 4 > HISTORY_TOKEN_BUDGET  # ~4 caracteres por token
+    if not pending or (len(pending) < SUMMARY_INTERVAL and not over_budget):
+        return
+    pending_text = "\n".join([f"{msg['role']}: {msg['content']}" for msg in pending])
+    summary_prompt = f"Resumen previo de la conversación:\n{st.session_state.history_summary or '(ninguno)'}\n\nNuevos mensajes:\n{pending_text}\n\nResume en una sola frase de qué se ha hablado hasta ahora, para usarlo como contexto de un asistente sobre el pliego de AEMET."
+    summary = await safe_generate_content(summary_prompt)
+    if summary != GENERATION_ERROR_MESSAGE:
+        st.session_state.history_summary = summary
+        st.session_state.summarized_messages = len(trimmed)
+
+async def process_turn(user_input):
+    """Ejecuta los pasos 1-4 del pipeline RAG y devuelve (query_vector, retrieved, ctx, answer).
+
+    query_vector es el vector de la primera variante de la consulta, que indexa la caché
+    semántica. answer solo viene informado si la respuesta sale de esa caché; si no, es None
+    y la respuesta final se genera en streaming con el contexto devuelto.
+    """
+    # 1. Expansión de la consulta en paráfrasis, vectorizando en paralelo la consulta original como respaldo
+    raw_embed_task = asyncio.create_task(safe_embed_content(user_input))
+    summary_task = asyncio.create_task(update_history_summary(st.session_state.conversation[:-1]))
+    query_vectors = None
+    if should_expand(user_input):
+        expand_prompt = f"Genera {QUERY_VARIANTS} paráfrasis expandidas lingüísticamente de esta consulta sobre el pliego de AEMET para mejorar su vectorización: \"{user_input}\". Responde únicamente con un array JSON de {QUERY_VARIANTS} cadenas, nada más. Ten en cuenta que cada paráfrasis se vectorizará directamente para un RAG, por lo que incluye únicamente lo necesario."
+        expanded_query = await safe_generate_content(expand_prompt)
+        logger.debug("La consulta expandida es: %s", expanded_query)
+
+        # 2. Vectorizar todas las variantes en una sola llamada
+        if expanded_query != GENERATION_ERROR_MESSAGE:
+            variants = parse_variants(expanded_query) or [expanded_query]
+            query_vectors = await safe_embed_contents(variants)
+    if query_vectors:
+        raw_embed_task.cancel()
+    else:
+        raw_vector = await raw_embed_task
+        query_vectors = [raw_vector] if raw_vector is not None else None
+    query_vector = query_vectors[0] if query_vectors else None
+
+    # Reutilizar la respuesta si ya se atendió una consulta similar
+    cached = cache_lookup(query_vector) if query_vector is not None else None
+    if cached:
+        retrieved, ctx, answer = cached
+        # El resumen no hace falta para responder desde la caché; se retomará en otro turno
+        summary_task.cancel()
+        return query_vector, retrieved, ctx, answer
+
+    # 3. Recuperar fragmentos del pliego: primero ids y similitudes, y después
+    # los metadatos (texto) solo de los fragmentos que superan el umbral
+    retrieved = []
+    retrieval_failed = False
+    if query_vectors:
         try:
-            embed = genai.embed_content(model="models/text-embedding-004", content=content)
-            if 'embedding' in embed:
-                return embed.get('embedding')
-            time.sleep(1)
+            index = get_async_index()
+            results = await asyncio.gather(*(
+                get_or_fetch(pinecone_cache_key(vector), functools.partial(query_pinecone, index, vector))
+                for vector in query_vectors
+            ))
+            matches = merge_matches(results)
+            if matches:
+                retrieved = await fetch_fragments(index, matches)
         except Exception as e:
-            st.warning(f"Error al generar embedding (intento {attempt+1}): {str(e)}")
-            time.sleep(1)
-    return None
+            st.error(f"Error al consultar Pinecone: {str(e)}")
+            retrieval_failed = True
+
+    # 4. Contexto para la respuesta: los fragmentos van directamente en el prompt final
+    # y solo se sintetizan antes si superan el presupuesto de tokens (~4 caracteres por token)
+    ctx = "\n---\n".join([f"[{f['documento']}]: {f['texto']}" for f in retrieved])
+    if retrieval_failed:
+        ctx = RETRIEVAL_ERROR_CONTEXT
+    elif not retrieved:
+        ctx = "No se encontraron fragmentos relevantes en el pliego para esta consulta."
+    elif len(ctx) // 4 > CONTEXT_TOKEN_BUDGET:
+        synth_prompt = f"Dado estos fragmentos del pliego:\n{ctx}\n\nSintetiza y organiza la información en un contexto claro para el asistente. Ten en cuenta que tu respuesta servirá como fuente de datos a un LLM para responder a la siguiente consulta: {user_input}"  
+        ctx = await safe_generate_content(synth_prompt)
+        logger.debug("Los fragmentos sintetizados son: %s", ctx)
+
+    await summary_task
+    return query_vector, retrieved, ctx, None
 
 # ---------------- Interfaz Principal ----------------
 st.title("☁️ Asistente del Pliego AEMET")
@@ -118,6 +591,7 @@ for msg in st.session_state.conversation:
             with st.expander("📚 Mostrar fragmentos recuperados"):
                 display_fragments(msg['fragments'])
 
+warmup()
 
 # Entrada del usuario
 user_input = st.chat_input("Escribe tu consulta sobre el pliego aquí...")
@@ -128,59 +602,36 @@ if user_input:
 
     with st.spinner("Procesando tu consulta..."):
         try:
-            # 1. Expansión de la consulta
-            expand_prompt = f"Expande lingüísticamente esta consulta sobre el pliego de AEMET para mejorar su vectorización: \"{user_input}\". Tu respuesta deber únicamente la consulta expandida, nada más. Ten en cuenta que tu respuesta se vectorizará directamente para un RAG, por lo que responde únicamente con lo necesario."
-            expanded_query = safe_generate_content(expand_prompt)
-            print ("La consulta expandida es: ", expanded_query)
-            
-            # 2. Vectorizar consulta expandida
-            query_vector = safe_embed_content(expanded_query)
-
-            # 3. Recuperar fragmentos del pliego
-            retrieved = []
-            if query_vector:
-                try:
-                    query_res = index.query(vector=query_vector, top_k=TOP_K, include_metadata=True)
-                    for m in query_res.get('matches', []):
-                        score = m.get('score', 0)
-                        if score >= MIN_SIMILARITY_SCORE:
-                            meta = m.get('metadata', {})
-                            retrieved.append({'texto': meta.get('texto',''), 'documento': meta.get('documento',''), 'score': score})
-                except Exception as e:
-                    st.error(f"Error al consultar Pinecone: {str(e)}")
-            
-            # 4. Síntesis de fragmentos
-            synthesized_context = ""
-            if retrieved:
-                ctx = "\n---\n".join([f"[{f['documento']}]: {f['texto']}" for f in retrieved])
-                synth_prompt = f"Dado estos fragmentos del pliego:\n{ctx}\n\nSintetiza y organiza la información en un contexto claro para el asistente. Ten en cuenta que tu respuesta servirá como fuente de datos a un LLM para responder a la siguiente consulta: {user_input}"  
-                synthesized_context = safe_generate_content(synth_prompt)
-                print("Los fragmentos sintetizados son: ", synthesized_context)
-            else:
-                synthesized_context = "No se encontraron fragmentos relevantes en el pliego para esta consulta."
-
-            # 5. Generar respuesta final
-            history = st.session_state.conversation[:-1]
-            formatted = format_history(history)
-            final_prompt = (
-                f"{CUSTOM_PROMPT}\n\nHistorial de conversación:\n{formatted}\n\n"
-                f"Contexto sintetizado:\n{synthesized_context}\n\n"
-                f"Consulta actual: {user_input}"
-            )
-            answer = safe_generate_content(final_prompt)
-            if not answer:
-                answer = "Lo siento, no pude generar una respuesta. Por favor, intenta reformular tu consulta."
-        
+            query_vector, retrieved, ctx, answer = asyncio.run(process_turn(user_input))
         except Exception as e:
             answer = f"Se produjo un error al procesar tu consulta: {str(e)}. Por favor, inténtalo de nuevo."
             retrieved = []
 
-    # Guardar y mostrar respuesta
-    st.session_state.conversation.append({'role':'Asistente','content': answer,'fragments': retrieved})
+    # Mostrar y guardar respuesta
     with st.chat_message('asistente', avatar=ASSISTANT_ICON):
-        st.markdown(answer)
+        if answer is None:
+            # 5. Generar respuesta final en streaming
+            formatted = format_history(st.session_state.conversation[:-1])
+            final_prompt = FINAL_TEMPLATE.format_map({"hist": formatted, "ctx": ctx, "q": user_input})
+            stream_status = {}
+            answer = st.write_stream(safe_stream_content(final_prompt, stream_status))
+            if not answer:
+                answer = "Lo siento, no pude generar una respuesta. Por favor, intenta reformular tu consulta."
+            else:
+                # Solo se cachean respuestas completas generadas con una recuperación correcta
+                cacheable = (
+                    query_vector is not None
+                    and ctx not in (RETRIEVAL_ERROR_CONTEXT, GENERATION_ERROR_MESSAGE)
+                    and answer != GENERATION_ERROR_MESSAGE
+                    and not stream_status.get('interrupted')
+                )
+                if cacheable:
+                    st.session_state.semantic_cache.insert(query_vector, retrieved, ctx, answer)
+        else:
+            st.markdown(answer)
         with st.expander("📚 Mostrar fragmentos recuperados"):
             display_fragments(retrieved)
+    st.session_state.conversation.append({'role':'Asistente','content': answer,'fragments': retrieved})
 
 # ---------------- Sidebar ----------------
 with st.sidebar: